@@ -1,6 +1,6 @@
 import streamlit as st
 
-from src.sql_pbi.lineage import perform_sql_analysis
+from src.sql_pbi.lineage import perform_sql_analysis, warm_up_sql_parser
 from src.sql_pbi.session import initialize_session_state
 from src.sql_pbi.ui import display_sidebar, display_query_input_area, display_analysis_results_tabs, \
     display_visual_configuration_section, display_pbi_automation_config_section, run_ai_dax_for_visual
@@ -12,6 +12,7 @@ def main():
     st.set_page_config(page_title="SQL to Power BI Mapper", page_icon="📊", layout="wide")
     
     initialize_session_state()
+    warm_up_sql_parser() # No-op after the first session of this process
     
     st.title("SQL to Power BI Column Mapper & Visual Configurator") # Updated title
     st.markdown("""
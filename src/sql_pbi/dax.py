@@ -1,19 +1,74 @@
 import streamlit as st
 import google.generativeai as genai
+import sqlparse
+import functools
+import json
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 from src.constants import API_KEY
-from src.sql_pbi.mapping import find_matching_powerbi_columns
+from src.sql_pbi.mapping import find_matching_powerbi_columns, pbi_dax_reference
 from src.sql_pbi.utils import FlowDict
 
-genai.configure(api_key=API_KEY)
+GEMINI_MODEL_NAME = 'gemini-2.5-flash-preview-05-20'
+# Bump when the DAX prompt or response schema changes, so cached generations from the old prompt are not reused
+DAX_PROMPT_VERSION = 2
+
+# Allowed Power BI data types for AI-generated measures
+DAX_DATA_TYPE_OPTIONS = [
+    "text", "whole number", "decimal number", "date/time",
+    "date", "time", "true/false", "fixed decimal number", "binary"
+]
+
+# Code fences around AI-generated DAX, and a bare "dax"/"DAX" tag left at the start of the expression
+_FENCE_RE = re.compile(r'```(?:dax\b)?|`+\s*$', re.IGNORECASE)
+_LEADING_DAX_RE = re.compile(r'^\s*dax\b\s*', re.IGNORECASE)
+
+# Prompt for generate_dax_from_sql; the data type list is filled in once here, the expression per call
+_DAX_PROMPT_TEMPLATE = """
+    Analyze the following SQL expression and provide:
+    1. measure: An equivalent PowerBI DAX expression for a MEASURE (properly formatted with line breaks and indentation for readability, don't give name to the measure, only show expression)
+    2. calculated_column: An equivalent PowerBI DAX expression for a CALCULATED COLUMN (properly formatted with line breaks and indentation for readability, don't give name to the calculated column only show expression)
+    3. recommendation: Whether this should be implemented as a "measure" or "calculated column" in PowerBI based on its characteristics
+    4. dataType: A suitable Power BI DATA TYPE for the MEASURE. Choose one from the following list: """ + ', '.join(DAX_DATA_TYPE_OPTIONS) + """.
+
+    SQL Expression:
+    ```sql
+    {sql_expression}
+    ```
+    """
+
+# Ask Gemini for a JSON object instead of free text that has to be split on markers
+_DAX_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "measure": {"type": "string"},
+            "calculated_column": {"type": "string"},
+            "recommendation": {"type": "string"},
+            "dataType": {"type": "string", "enum": DAX_DATA_TYPE_OPTIONS},
+        },
+        "required": ["measure", "calculated_column", "recommendation", "dataType"],
+    },
+}
+
+@functools.lru_cache(maxsize=1024)
+def _base_column_pattern(sql_tokens):
+    """Compiled alternation of the given base columns (already ordered longest-first)."""
+    return re.compile('|'.join(map(re.escape, sql_tokens)))
+
 
 def generate_powerbi_equivalent_formula(original_sql_expression, base_columns_from_lineage, column_mappings_dict, resolved_base_col_to_pbi=None):
     if not original_sql_expression or not base_columns_from_lineage or not column_mappings_dict:
         return original_sql_expression, False
 
     replacements = {}
-    sorted_unique_base_columns = sorted(list(set(base_columns_from_lineage)), key=len, reverse=True)
+    base_col_ambiguity_choices = st.session_state.get('base_col_ambiguity_choices', {}) # Read once, not per column
+    # Only base columns that literally occur in the expression can be replaced, so only those are resolved
+    sorted_unique_base_columns = sorted(
+        (col for col in set(base_columns_from_lineage) if col in original_sql_expression), key=len, reverse=True)
 
     for sql_base_col_str in sorted_unique_base_columns:
         dax_full_ref = None
@@ -21,136 +76,84 @@ def generate_powerbi_equivalent_formula(original_sql_expression, base_columns_fr
         if resolved_base_col_to_pbi and sql_base_col_str in resolved_base_col_to_pbi:
             dax_full_ref = resolved_base_col_to_pbi[sql_base_col_str]
         else:
-            resolved_label = st.session_state.get('base_col_ambiguity_choices', {}).get(sql_base_col_str)
+            resolved_label = base_col_ambiguity_choices.get(sql_base_col_str)
             pbi_matches = find_matching_powerbi_columns(sql_base_col_str, column_mappings_dict)
             if resolved_label and pbi_matches:
-                resolved = next((m for m in pbi_matches if f"'{m['table']}'[{m['column']}]" == resolved_label), None)
-                if resolved:
+                if resolved_label in {pbi_dax_reference(m) for m in pbi_matches}:
                     dax_full_ref = resolved_label
             elif pbi_matches:
-                first_match = pbi_matches[0]
-                pbi_table = first_match.get("table")
-                pbi_column = first_match.get("column")
-                if pbi_table and pbi_column:
-                    dax_full_ref = f"'{pbi_table}'[{pbi_column}]"
+                dax_full_ref = pbi_dax_reference(pbi_matches[0]) # None if the first match has no table/column
         if dax_full_ref:
             replacements[sql_base_col_str] = dax_full_ref
 
     if not replacements:
         return original_sql_expression, False
 
-    modified_expression = original_sql_expression
-    made_change = False
+    # One left-to-right pass over the expression; alternatives are ordered longest-first so the longest
+    # base column wins where several start at the same position, and inserted DAX is never re-scanned
+    replacement_pattern = _base_column_pattern(tuple(
+        sql_token for sql_token in sorted_unique_base_columns if sql_token in replacements))
+    modified_expression = replacement_pattern.sub(lambda m: replacements[m.group(0)], original_sql_expression)
+
+    return modified_expression, modified_expression != original_sql_expression
 
-    for sql_token_to_replace in sorted_unique_base_columns:
-        if sql_token_to_replace in replacements:
-            dax_equivalent = replacements[sql_token_to_replace]
-            if sql_token_to_replace in modified_expression:
-                modified_expression = modified_expression.replace(sql_token_to_replace, dax_equivalent)
-                made_change = True
 
-    return modified_expression, made_change
+def cached_powerbi_equivalent_formula(original_sql_expression, base_columns_from_lineage, column_mappings_dict, resolved_base_col_to_pbi=None):
+    """
+    generate_powerbi_equivalent_formula, memoized on the expression, its base columns, the mapping
+    file version and the resolved/ambiguity choice of each base column.
+    """
+    mappings_version = column_mappings_dict.get("_version") if column_mappings_dict else None
+    if mappings_version is None or not original_sql_expression or not base_columns_from_lineage:
+        # Nothing stable to key on (or nothing to translate)
+        return generate_powerbi_equivalent_formula(
+            original_sql_expression, base_columns_from_lineage, column_mappings_dict, resolved_base_col_to_pbi)
+
+    base_columns = tuple(base_columns_from_lineage)
+    resolved_base_col_to_pbi = resolved_base_col_to_pbi or {}
+    base_col_ambiguity_choices = st.session_state.get('base_col_ambiguity_choices', {})
+    return _cached_powerbi_equivalent_formula(
+        original_sql_expression, base_columns, mappings_version,
+        tuple(resolved_base_col_to_pbi.get(base_col) for base_col in base_columns),
+        tuple(base_col_ambiguity_choices.get(base_col) for base_col in base_columns),
+        column_mappings_dict, resolved_base_col_to_pbi)
+
+
+@st.cache_data(show_spinner=False, max_entries=4096)
+def _cached_powerbi_equivalent_formula(original_sql_expression, base_columns, mappings_version, resolved_refs,
+                                       ambiguity_choices, _column_mappings_dict, _resolved_base_col_to_pbi):
+    # The _-prefixed arguments are excluded from hashing by Streamlit; mappings_version, resolved_refs and
+    # ambiguity_choices (per base column) identify everything the translation reads from them.
+    return generate_powerbi_equivalent_formula(
+        original_sql_expression, base_columns, _column_mappings_dict, _resolved_base_col_to_pbi)
+
+
+@functools.lru_cache(maxsize=1)
+def _configure_gemini():
+    """Configures the Gemini SDK on first use instead of at import, so pages that never call the AI skip it."""
+    # Read at call time: the .env file is loaded after this module is imported
+    api_key = os.getenv("GEMINI_API_KEY") or API_KEY
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY not set")
+    genai.configure(api_key=api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_gemini_model(model_name=GEMINI_MODEL_NAME):
+    """Builds the Gemini client once per process; it is shared by all sessions."""
+    return genai.GenerativeModel(model_name)
 
 
 def generate_dax_from_sql(sql_expression):
+    """
+    Asks Gemini for measure / calculated column DAX for a SQL expression.
+    Successful answers are cached for a day per expression, so repeated clicks (and other sessions)
+    skip the round-trip; failures are not cached and are returned as an error dict.
+    The cache key ignores SQL comments, but the prompt gets the expression with its comments intact.
+    """
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
-        # Define the allowed data types for the prompt
-        data_type_options = [
-            "text", "whole number", "decimal number", "date/time", 
-            "date", "time", "true/false", "fixed decimal number", "binary"
-        ]
-        prompt = f"""
-        Analyze the following SQL expression and provide:
-        1. An equivalent PowerBI DAX expression for a MEASURE (properly formatted with line breaks and indentation for readability, don't give name to the measure, only show expression)
-        2. An equivalent PowerBI DAX expression for a CALCULATED COLUMN (properly formatted with line breaks and indentation for readability, don't give name to the calculated column only show expression)
-        3. A recommendation on whether this should be implemented as a measure or calculated column in PowerBI based on its characteristics
-        4. A suitable Power BI DATA TYPE for the MEASURE. Choose one from the following list: {', '.join(data_type_options)}.
-
-        SQL Expression:
-        ```sql
-        {sql_expression}
-        ```
-
-        Format your response exactly like this example with no additional text:
-        MEASURE:
-        CALCULATE(
-            SUM(Sales[Revenue]),
-            Sales[Year] = 2023
-        )
-        CALCULATED_COLUMN:
-        IF(
-            [Price] * [Quantity] > 1000,
-            "High Value",
-            "Standard"
-        )
-        RECOMMENDATION: measure
-        DATA_TYPE: decimal number
-        """
-
-        response = model.generate_content(prompt)
-        dax_response = response.text.strip()
-
-        sections = {
-            'measure': '',
-            'calculated_column': '',
-            'recommendation': '',
-            'dataType': 'text'  # Default dataType
-        }
-
-        # print(response)
-
-        measure_marker = "MEASURE:"
-        calc_col_marker = "CALCULATED_COLUMN:"
-        rec_marker = "RECOMMENDATION:"
-        datatype_marker = "DATA_TYPE:" # Changed from FORMAT_STRING
-
-        idx_measure = dax_response.find(measure_marker)
-        idx_calc_col = dax_response.find(calc_col_marker)
-        idx_rec = dax_response.find(rec_marker)
-        idx_datatype = dax_response.find(datatype_marker) # Changed
-
-        if idx_measure != -1:
-            start_measure = idx_measure + len(measure_marker)
-            end_measure = idx_calc_col if idx_calc_col != -1 else (idx_rec if idx_rec != -1 else (idx_datatype if idx_datatype != -1 else len(dax_response)))
-            sections['measure'] = dax_response[start_measure:end_measure].strip()
-
-        if idx_calc_col != -1:
-            start_calc_col = idx_calc_col + len(calc_col_marker)
-            end_calc_col = idx_rec if idx_rec != -1 else (idx_datatype if idx_datatype != -1 else len(dax_response))
-            sections['calculated_column'] = dax_response[start_calc_col:end_calc_col].strip()
-
-        if idx_rec != -1:
-            start_rec = idx_rec + len(rec_marker)
-            end_rec = idx_datatype if idx_datatype != -1 else len(dax_response)
-            sections['recommendation'] = dax_response[start_rec:end_rec].strip()
-        
-        if idx_datatype != -1: # Changed
-            start_datatype = idx_datatype + len(datatype_marker) # Changed
-            sections['dataType'] = dax_response[start_datatype:].strip() # Changed
-
-        # Clean up measure and calculated_column DAX
-        for key in ['measure', 'calculated_column']:
-            sections[key] = sections[key].replace('```dax', '').replace('```', '')
-            if sections[key].lstrip().startswith('dax'):
-                sections[key] = sections[key].lstrip()[3:].lstrip()
-            if sections[key].lstrip().startswith('DAX'):
-                sections[key] = sections[key].lstrip()[3:].lstrip()
-            sections[key] = sections[key].rstrip('`').strip()
-        
-        # Clean up dataType (remove potential quotes and validate against allowed list)
-        dt = sections['dataType']
-        if dt.startswith('"') and dt.endswith('"'):
-            dt = dt[1:-1]
-        if dt.startswith("'") and dt.endswith("'"):
-            dt = dt[1:-1]
-        
-        if dt.lower() not in data_type_options: # Validate
-            sections['dataType'] = 'text' # Fallback to default if AI gives invalid type
-        else:
-            sections['dataType'] = dt.lower() # Store in lowercase for consistency
-
-        return sections
+        return _generate_dax_from_sql_cached(
+            _dax_cache_key(sql_expression), GEMINI_MODEL_NAME, DAX_PROMPT_VERSION, (sql_expression or "").strip())
     except Exception as e:
         return {
             "measure": f"Error: {str(e)}",
@@ -159,6 +162,75 @@ def generate_dax_from_sql(sql_expression):
             "dataType": "text" # Default dataType on error
         }
 
+
+def _dax_cache_key(sql_expression):
+    """
+    Comments and surrounding whitespace do not change the expression, so they should not miss the cache.
+    Comment markers inside string literals are kept:
+
+    >>> _dax_cache_key("CASE WHEN x = '--a' THEN 1 END -- note")
+    "CASE WHEN x = '--a' THEN 1 END"
+    >>> _dax_cache_key("CONCAT(a, '/* b */') /* c */")
+    "CONCAT(a, '/* b */')"
+    """
+    sql_expression = (sql_expression or "").strip()
+    if '--' in sql_expression or '/*' in sql_expression: # Only tokenize when there can be a comment
+        sql_expression = sqlparse.format(sql_expression, strip_comments=True).strip()
+    return sql_expression
+
+
+def generate_dax_batch(sql_expressions, max_workers=8):
+    """
+    Runs generate_dax_from_sql for several expressions concurrently, so N expressions cost about
+    one round-trip instead of N. Results come back in input order; duplicates are only sent once.
+    """
+    unique_expressions = list(dict.fromkeys(sql_expressions))
+    if not unique_expressions:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_expressions))) as executor:
+        results_by_expression = dict(zip(unique_expressions, executor.map(generate_dax_from_sql, unique_expressions)))
+    return [results_by_expression[expr] for expr in sql_expressions]
+
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _generate_dax_from_sql_cached(cache_key, model_name, prompt_version, _sql_expression):
+    # Raises on API errors so that only successful responses end up in the cache.
+    # cache_key (comment-free SQL), model_name and prompt_version form the cache key; the prompt itself lives
+    # at module level. _sql_expression is not hashed: it is the original SQL, comments included, so the model
+    # still sees any explanation they give.
+    _configure_gemini()
+    model = _get_gemini_model(model_name)
+    prompt = _DAX_PROMPT_TEMPLATE.format(sql_expression=_sql_expression)
+
+    # Structured output: the model returns one JSON object matching the schema, so no marker parsing is needed
+    response = model.generate_content(prompt, generation_config=_DAX_GENERATION_CONFIG)
+    parsed_response = json.loads(response.text)
+
+    sections = {
+        'measure': str(parsed_response.get('measure') or ''),
+        'calculated_column': str(parsed_response.get('calculated_column') or ''),
+        'recommendation': str(parsed_response.get('recommendation') or '').strip(),
+        'dataType': str(parsed_response.get('dataType') or 'text').strip()  # Default dataType
+    }
+
+    # Clean up measure and calculated_column DAX (code fences and a leading "dax" language tag)
+    for key in ['measure', 'calculated_column']:
+        sections[key] = _LEADING_DAX_RE.sub('', _FENCE_RE.sub('', sections[key])).strip()
+    
+    # Clean up dataType (remove potential quotes and validate against allowed list)
+    dt = sections['dataType']
+    if dt.startswith('"') and dt.endswith('"'):
+        dt = dt[1:-1]
+    if dt.startswith("'") and dt.endswith("'"):
+        dt = dt[1:-1]
+    
+    if dt.lower() not in DAX_DATA_TYPE_OPTIONS: # Validate
+        sections['dataType'] = 'text' # Fallback to default if AI gives invalid type
+    else:
+        sections['dataType'] = dt.lower() # Store in lowercase for consistency
+
+    return sections
+
 def parse_dax_filter_for_display(dax_string):
     """
     Parses a DAX filter string (potentially SQL-like) for display purposes.
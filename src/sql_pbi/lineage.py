@@ -1,31 +1,142 @@
+import itertools
+import re
+
+import pandas as pd
 import streamlit as st
+import sqlglot
 
 from src.utils.sql_analyzer import SQLLineageAnalyzer
-from src.sql_pbi.dax import generate_powerbi_equivalent_formula
-from src.sql_pbi.mapping import find_matching_powerbi_columns, normalize_column_identifier
+from src.sql_pbi.dax import cached_powerbi_equivalent_formula
+from src.sql_pbi.mapping import find_matching_powerbi_columns, normalize_column_identifier, pbi_dax_reference
+
+# Source of mapping_results_version values; unique across sessions of this process
+_MAPPING_RESULTS_VERSIONS = itertools.count(1)
+
+# First 'Table'[ reference in a DAX expression
+_PBI_TABLE_REF_RE = re.compile(r"'([^']+)'\[")
+# A DAX expression that is exactly one 'Table'[Column] reference
+_PBI_COLUMN_REF_RE = re.compile(r"^\s*'([^']+)'\[([^\]]+)\]\s*$")
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up_sql_parser(dialect="snowflake"):
+    """Parses a trivial query once per process so the dialect's tokenizer/parser tables are built before the first analysis."""
+    sqlglot.parse_one("SELECT 1", read=dialect)
+    return True
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _analyze_sql(sql_query, dialect="snowflake"):
+    """
+    Lineage for a query plus the sorted item types in it ('column' shown as 'base').
+    Re-analyzing the same text is served from the cache (each caller gets its own copy).
+    """
+    lineage_data = SQLLineageAnalyzer(sql_query, dialect=dialect).analyze()
+    types_in_data = set()
+    for item in lineage_data or []:
+        item_type = item.get('type')
+        if item_type == 'column': 
+            types_in_data.add('base')
+        elif item_type:
+            types_in_data.add(item_type)
+    return lineage_data, sorted(types_in_data)
+
+
+def build_mapping_results(lineage_data, column_mappings):
+    """
+    Maps every non-filter lineage item (via its base columns, or the item itself when it has none)
+    to PBI columns. Returns {sql_item_name: {'type', 'base_column_mappings', 'is_mapped_overall'}}.
+    Cached on the lineage content plus the mapping file version when the mappings carry one.
+    """
+    mappings_version = (column_mappings or {}).get("_version")
+    if mappings_version is None:
+        return _build_mapping_results(lineage_data, column_mappings)
+    return _cached_build_mapping_results(lineage_data, mappings_version, column_mappings)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _cached_build_mapping_results(lineage_data, mappings_version, _column_mappings):
+    # _column_mappings is excluded from hashing by Streamlit; mappings_version identifies it.
+    return _build_mapping_results(lineage_data, _column_mappings)
+
+
+def _build_mapping_results(lineage_data, column_mappings):
+    temp_mapping_results = {}
+    # Base columns recur across lineage items; normalize and match each distinct string only once
+    base_col_mapping_cache = {}
+
+    def base_col_mapping(col_str):
+        if col_str not in base_col_mapping_cache:
+            base_col_mapping_cache[col_str] = {
+                'original_base_col': col_str,
+                'normalized_base_col': normalize_column_identifier(col_str),
+                'pbi_matches': find_matching_powerbi_columns(col_str, column_mappings)
+            }
+        return base_col_mapping_cache[col_str]
+
+    for item_map in lineage_data:
+        if item_map.get('type') != 'filter_condition':
+            sql_col_name = item_map.get('item', item_map.get('column')) # Use 'item' first
+            if sql_col_name:
+                base_cols_for_map = item_map.get('base_columns', [])
+                pbi_matches_for_map = []
+                is_mapped_overall_map = False
+                for bc_map in base_cols_for_map:
+                    bc_mapping = base_col_mapping(bc_map)
+                    if bc_mapping['pbi_matches']: is_mapped_overall_map = True
+                    pbi_matches_for_map.append(bc_mapping)
+                # If not an expression and no base_columns, try to map the item itself
+                if item_map.get('type') != 'expression' and not base_cols_for_map:
+                    # Add a structure for direct mapping if needed by tab3
+                    direct_mapping = base_col_mapping(sql_col_name) # Treat the item itself as a "base" for mapping display
+                    if direct_mapping['pbi_matches']: is_mapped_overall_map = True
+                    pbi_matches_for_map.append(direct_mapping)
+
+
+                temp_mapping_results[sql_col_name] = {
+                    'type': item_map.get('type'),
+                    'base_column_mappings': pbi_matches_for_map,
+                    'is_mapped_overall': is_mapped_overall_map
+                }
+    return temp_mapping_results
+
+
+def resolve_base_col_to_pbi(base_col_pbi_matches, base_col_ambiguity_choices):
+    """
+    Picks one 'Table'[Column] reference per base column: the user's ambiguity choice when it is
+    one of the matches, otherwise the first match. Columns without a usable match are left out.
+    """
+    resolved_base_col_to_pbi = {}
+    for base_col, matches in base_col_pbi_matches.items():
+        if not matches:
+            continue
+        resolved_label = base_col_ambiguity_choices.get(base_col)
+        if resolved_label:
+            if any(pbi_dax_reference(m) == resolved_label for m in matches):
+                resolved_base_col_to_pbi[base_col] = resolved_label
+        else: # Single match, or no choice made yet (e.g. first run): the first match is the default
+            first_dax_ref = pbi_dax_reference(matches[0])
+            if first_dax_ref:
+                resolved_base_col_to_pbi[base_col] = first_dax_ref
+    return resolved_base_col_to_pbi
 
 
 def perform_sql_analysis(sql_query):
     """Performs SQL analysis and updates session state."""
     try:
         with st.spinner("Analyzing query..."):
-            analyzer = SQLLineageAnalyzer(sql_query, dialect="snowflake")
-            st.session_state['lineage_data'] = analyzer.analyze()
+            # Only the surrounding whitespace is dropped; inner whitespace can matter inside string literals
+            lineage_data, types_in_data = _analyze_sql(sql_query.strip(), "snowflake")
+            st.session_state['lineage_data'] = lineage_data
+            # Tabular form of the lineage, built once here instead of on every rerun of the results tabs
+            st.session_state['lineage_df'] = pd.DataFrame(lineage_data) if lineage_data else None
+            if st.session_state['lineage_df'] is not None and 'type' in st.session_state['lineage_df']:
+                # Few distinct values: categorical codes make the type filters cheap comparisons
+                st.session_state['lineage_df']['type'] = st.session_state['lineage_df']['type'].astype('category')
             
             if st.session_state['lineage_data']:
-                types_in_data = set()
-                for item in st.session_state['lineage_data']:
-                    item_type = item.get('type')
-                    if item_type == 'column': 
-                        types_in_data.add('base')
-                    elif item_type:
-                        types_in_data.add(item_type)
-                st.session_state['all_types'] = sorted(list(types_in_data))
+                st.session_state['all_types'] = types_in_data
                 
-                # Initial pass for visual candidates (will be refined by build_visual_candidates)
-                # This part is simplified as build_visual_candidates does the heavy lifting
-                st.session_state['visual_config_candidates'] = build_visual_candidates() # Call the more detailed builder
-
                 # Reset selections and AI results when query is re-analyzed
                 st.session_state['visual_selected_rows'] = []
                 st.session_state['visual_selected_columns'] = []
@@ -40,62 +151,79 @@ def perform_sql_analysis(sql_query):
                 st.session_state['translated_filter_conditions'] = []
                 st.session_state['visual_selected_filters_dax'] = []
 
-                # Prepare mapping_results (simplified, ensure your original logic is preserved or integrated here)
-                # This is a placeholder for your mapping_results generation logic
-                temp_mapping_results = {}
-                for item_map in st.session_state['lineage_data']:
-                    if item_map.get('type') != 'filter_condition':
-                        sql_col_name = item_map.get('item', item_map.get('column')) # Use 'item' first
-                        if sql_col_name:
-                            base_cols_for_map = item_map.get('base_columns', [])
-                            pbi_matches_for_map = []
-                            is_mapped_overall_map = False
-                            for bc_map in base_cols_for_map:
-                                matches_bc = find_matching_powerbi_columns(bc_map, st.session_state['column_mappings'])
-                                if matches_bc: is_mapped_overall_map = True
-                                pbi_matches_for_map.append({
-                                    'original_base_col': bc_map,
-                                    'normalized_base_col': normalize_column_identifier(bc_map),
-                                    'pbi_matches': matches_bc
-                                })
-                            # If not an expression and no base_columns, try to map the item itself
-                            if item_map.get('type') != 'expression' and not base_cols_for_map:
-                                direct_matches = find_matching_powerbi_columns(sql_col_name, st.session_state['column_mappings'])
-                                if direct_matches: is_mapped_overall_map = True
-                                # Add a structure for direct mapping if needed by tab3
-                                pbi_matches_for_map.append({
-                                     'original_base_col': sql_col_name, # Treat the item itself as a "base" for mapping display
-                                     'normalized_base_col': normalize_column_identifier(sql_col_name),
-                                     'pbi_matches': direct_matches
-                                 })
-
-
-                            temp_mapping_results[sql_col_name] = {
-                                'type': item_map.get('type'),
-                                'base_column_mappings': pbi_matches_for_map,
-                                'is_mapped_overall': is_mapped_overall_map
-                            }
+                # PBI matches for every distinct base column, including those only used in filter conditions
+                st.session_state['base_col_pbi_matches'] = {
+                    base_col: find_matching_powerbi_columns(base_col, st.session_state['column_mappings'])
+                    for item in st.session_state['lineage_data'] for base_col in item.get('base_columns') or []
+                }
+                # Resolve every base column once up front, so translations do not re-resolve per expression
+                st.session_state['resolved_base_col_to_pbi'] = resolve_base_col_to_pbi(
+                    st.session_state['base_col_pbi_matches'], st.session_state['base_col_ambiguity_choices'])
+
+                # Visual candidates (after the resets above, so they use this query's resolutions)
+                st.session_state['visual_config_candidates'] = build_visual_candidates()
+
+                # PBI matches per SQL item, computed once per (query lineage, mapping file version)
+                temp_mapping_results = build_mapping_results(st.session_state['lineage_data'], st.session_state['column_mappings'])
                 st.session_state['mapping_results'] = temp_mapping_results
+                mapped_count = sum(1 for res in temp_mapping_results.values() if res['is_mapped_overall'])
+                st.session_state['mapping_stats'] = {
+                    'total': len(temp_mapping_results),
+                    'mapped': mapped_count,
+                    'unmapped': len(temp_mapping_results) - mapped_count
+                }
+                # New on every analysis so caches keyed on mapping_results are invalidated. Those caches are shared
+                # by all sessions, so the value comes from a process-wide counter rather than a per-session one.
+                st.session_state['mapping_results_version'] = next(_MAPPING_RESULTS_VERSIONS)
 
     except Exception as e:
         st.error(f"Error analyzing query or preparing visual candidates: {str(e)}")
         st.exception(e)
         st.session_state['lineage_data'] = None # Clear data on error
+        st.session_state['lineage_df'] = None
         st.session_state['visual_config_candidates'] = []
         st.session_state['mapping_results'] = None
+        st.session_state['base_col_pbi_matches'] = {}
+
+
 
+def _resolved_option(resolved_label, pbi_matches_by_label, sql_name):
+    """Single-option list for a resolved 'Table'[Column] choice, or None if it is not one of the matches."""
+    resolved = pbi_matches_by_label.get(resolved_label) if resolved_label else None
+    if not resolved:
+        return None
+    return [{
+        'display_label': resolved_label,
+        'pbi_dax_reference': resolved_label,
+        'table': resolved['table'],
+        'column': resolved['column'],
+        'is_expression_translation': False,
+        'original_sql_column_alias': sql_name,
+        'original_sql_expression': None
+    }]
 
 
-def build_visual_candidates():
+def build_visual_candidates(changed_base_cols=None):
+    """
+    Builds one visual candidate per non-filter lineage item. When changed_base_cols is given (an
+    ambiguity choice changed), only items that are, or use, one of those columns are rebuilt;
+    the other candidates are reused from session state as they are.
+    """
     visual_candidates = []
     if not st.session_state.get('lineage_data'):
         return []
+    existing_candidates_by_id = {} # id -> candidates in build order (ids repeat when SQL items share a name)
+    if changed_base_cols is not None:
+        for existing_candidate in st.session_state.get('visual_config_candidates', []):
+            existing_candidates_by_id.setdefault(existing_candidate['id'], []).append(existing_candidate)
     
 
     # Fetch mappings and resolved choices from session state to use within the function
     column_mappings = st.session_state.get('column_mappings', {})
     expression_to_pbi_map = column_mappings.get('expression_to_powerbi', {})
     resolved_base_col_to_pbi = st.session_state.get('resolved_base_col_to_pbi', {})
+    base_col_ambiguity_choices = st.session_state.get('base_col_ambiguity_choices', {})
+    visual_ambiguity_choices = st.session_state.get('visual_ambiguity_choices', {})
 
 
     for item_vis_conf in st.session_state['lineage_data']:
@@ -108,6 +236,13 @@ def build_visual_candidates():
             st.warning(f"Skipping lineage item due to missing 'item' key: {item_vis_conf}")
             continue
 
+        previous_candidates = existing_candidates_by_id.get(sql_name)
+        previous_candidate = previous_candidates.pop(0) if previous_candidates else None
+        if previous_candidate is not None and sql_name not in changed_base_cols \
+                and changed_base_cols.isdisjoint(item_vis_conf.get('base_columns') or ()):
+            visual_candidates.append(previous_candidate) # Not affected by the changed choices
+            continue
+
         is_analyzer_expression_type = item_vis_conf['type'] == 'expression'
 
         effective_type_is_expression = is_analyzer_expression_type
@@ -117,46 +252,32 @@ def build_visual_candidates():
 
         if not is_analyzer_expression_type:
             # Try mapping the SQL output column directly
-            pbi_matches = find_matching_powerbi_columns(sql_name, st.session_state['column_mappings'])
+            pbi_matches = find_matching_powerbi_columns(sql_name, column_mappings)
+            mapped_base_col = None
 
             # If not mapped, and has a single base column, try mapping the base column.
             if not pbi_matches and base_columns_from_lineage and len(base_columns_from_lineage) == 1:
-                base_col = base_columns_from_lineage[0]
-                pbi_matches = find_matching_powerbi_columns(base_col, st.session_state['column_mappings'])
-                # Use resolved mapping if ambiguity was resolved for this base column
-                resolved_label = st.session_state['base_col_ambiguity_choices'].get(base_col)
-                if resolved_label and pbi_matches:
-                    resolved = next((m for m in pbi_matches if f"'{m['table']}'[{m['column']}]" == resolved_label), None)
-                    if resolved:
-                        pbi_options_for_item = [{
-                            'display_label': resolved_label,
-                            'pbi_dax_reference': resolved_label,
-                            'table': resolved['table'],
-                            'column': resolved['column'],
-                            'is_expression_translation': False,
-                            'original_sql_column_alias': sql_name,
-                            'original_sql_expression': None
-                        }]
-            # Use resolved mapping if ambiguity was resolved for this output column
-            resolved_label = st.session_state['base_col_ambiguity_choices'].get(sql_name)
-            if resolved_label and pbi_matches:
-                resolved = next((m for m in pbi_matches if f"'{m['table']}'[{m['column']}]" == resolved_label), None)
-                if resolved:
-                    pbi_options_for_item = [{
-                        'display_label': resolved_label,
-                        'pbi_dax_reference': resolved_label,
-                        'table': resolved['table'],
-                        'column': resolved['column'],
-                        'is_expression_translation': False,
-                        'original_sql_column_alias': sql_name,
-                        'original_sql_expression': None
-                    }]
-            elif pbi_matches and not pbi_options_for_item:
+                mapped_base_col = base_columns_from_lineage[0]
+                pbi_matches = find_matching_powerbi_columns(mapped_base_col, column_mappings)
+
+            # DAX reference -> match, so resolved choices are a dict probe; the first match wins for duplicates
+            pbi_matches_by_label = {}
+            for match in pbi_matches:
+                pbi_matches_by_label.setdefault(pbi_dax_reference(match), match)
+
+            # Use resolved mapping if ambiguity was resolved for this output column; it takes precedence
+            sql_name_resolved_label = base_col_ambiguity_choices.get(sql_name)
+            pbi_options_for_item = _resolved_option(sql_name_resolved_label, pbi_matches_by_label, sql_name) or []
+            if not pbi_options_for_item and mapped_base_col is not None:
+                # Otherwise use resolved mapping if ambiguity was resolved for the mapped base column
+                pbi_options_for_item = _resolved_option(
+                    base_col_ambiguity_choices.get(mapped_base_col), pbi_matches_by_label, sql_name) or []
+            if pbi_matches and not pbi_options_for_item and not sql_name_resolved_label:
                 for match in pbi_matches:
                     tbl = match.get("table")
                     col = match.get("column")
-                    if tbl and col:
-                        pbi_dax_ref = f"'{tbl}'[{col}]"
+                    pbi_dax_ref = pbi_dax_reference(match)
+                    if pbi_dax_ref:
                         pbi_options_for_item.append({
                             'display_label': pbi_dax_ref,
                             'pbi_dax_reference': pbi_dax_ref,
@@ -190,18 +311,15 @@ def build_visual_candidates():
                 # This assumes keys in your JSON are also stored in this normalized format.
                 final_lookup_key = ' '.join(expression_for_lookup.upper().split())
                 
-                for map_key, map_value in expression_to_pbi_map.items():
-                    if final_lookup_key == map_key:
-                        direct_pbi_matches = map_value
-                        break # Found a match, exit the loop
+                direct_pbi_matches = expression_to_pbi_map.get(final_lookup_key) # Keys are unique: a dict probe, not a scan
 
                 if direct_pbi_matches:
                     effective_type_is_expression = False
                     # Direct mapping found. Treat it like a base column with one or more options.
                     for match in direct_pbi_matches:
                         tbl, col = match.get("table"), match.get("column")
-                        if tbl and col:
-                            pbi_dax_ref = f"'{tbl}'[{col}]"
+                        pbi_dax_ref = pbi_dax_reference(match)
+                        if pbi_dax_ref:
                             pbi_options_for_item.append({'display_label': pbi_dax_ref, 'pbi_dax_reference': pbi_dax_ref, 'table': tbl, 'column': col, 'is_expression_translation': False, 'original_sql_column_alias': sql_name, 'original_sql_expression': original_sql_content_for_expr})
                 else:
                     # 2. No direct mapping, fall back to base column replacement logic
@@ -209,7 +327,7 @@ def build_visual_candidates():
                     actual_pbi_dax_reference = original_sql_content_for_expr or sql_name
                     made_change = False
                     if original_sql_content_for_expr:
-                        translated_expr, made_change = generate_powerbi_equivalent_formula(
+                        translated_expr, made_change = cached_powerbi_equivalent_formula(
                             original_sql_content_for_expr,
                             base_columns_from_lineage,
                             column_mappings,
@@ -225,9 +343,14 @@ def build_visual_candidates():
             default_chosen_display_label = pbi_options_for_item[0]['display_label']
             default_chosen_pbi_dax_reference = pbi_options_for_item[0]['pbi_dax_reference']        
 
-            pre_chosen_display_label_from_session = st.session_state.get('visual_ambiguity_choices', {}).get(sql_name)
+            # Label -> option index; the first option wins for duplicate labels
+            pbi_options_by_label = {}
+            for opt in pbi_options_for_item:
+                pbi_options_by_label.setdefault(opt['display_label'], opt)
+
+            pre_chosen_display_label_from_session = visual_ambiguity_choices.get(sql_name)
             if pre_chosen_display_label_from_session:
-                found_option_for_pre_choice = next((opt for opt in pbi_options_for_item if opt['display_label'] == pre_chosen_display_label_from_session), None)
+                found_option_for_pre_choice = pbi_options_by_label.get(pre_chosen_display_label_from_session)
                 if found_option_for_pre_choice:
                     default_chosen_display_label = found_option_for_pre_choice['display_label']    
                     default_chosen_pbi_dax_reference = found_option_for_pre_choice['pbi_dax_reference']
@@ -250,11 +373,16 @@ def enrich_selected_items(selected_labels):
     This version correctly uses the pre-calculated 'chosen_pbi_dax_reference' and
     the final 'is_sql_expression_type_from_analyzer' flag, avoiding any re-translation.
     """
-    import re
+    # Index candidates by their chosen label once; the first candidate wins for duplicate labels
+    candidates_by_label = {}
+    for c in st.session_state.get('visual_config_candidates', []):
+        if c.get('chosen_display_label'):
+            candidates_by_label.setdefault(c['chosen_display_label'], c)
+
     enriched = []
     for label in selected_labels:
         # Find the full candidate object that corresponds to the selected label
-        candidate = next((c for c in st.session_state.get('visual_config_candidates', []) if c.get('chosen_display_label') == label), None)
+        candidate = candidates_by_label.get(label)
         
         if not candidate:
             continue
@@ -279,12 +407,12 @@ def enrich_selected_items(selected_labels):
         if pbi_expression:
             if is_expression_type:
                 # For complex expressions, search for the first table reference. We don't need the column.
-                match = re.search(r"'([^']+)'\[", pbi_expression)
+                match = _PBI_TABLE_REF_RE.search(pbi_expression)
                 if match:
                     entry["pbi_table"] = match.group(1)
             else:
                 # For base types, the string should match the 'Table'[Column] format exactly.
-                match = re.match(r"^\s*'([^']+)'\[([^\]]+)\]\s*$", pbi_expression)
+                match = _PBI_COLUMN_REF_RE.match(pbi_expression)
                 if match:
                     entry["pbi_table"] = match.group(1)
                     entry["pbi_column"] = match.group(2)
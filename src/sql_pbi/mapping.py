@@ -1,35 +1,119 @@
 from src.constants import MAPPING_FILE_PATH
+import functools
 import json
+import os
 
+import streamlit as st
 
+try:
+    import orjson # Optional: parses the mapping file several times faster than the stdlib
+except ImportError:
+    orjson = None
+
+
+# Translation table that drops every double quote in a single C-level pass
+_QUOTE_TABLE = str.maketrans('', '', '"')
+
+
+@functools.lru_cache(maxsize=16384)
 def normalize_column_identifier(column_id):
     """Normalize column identifiers by removing quotes and extracting the important parts."""
     if not column_id: # Handles None or empty string
         return ""
         
-    # Remove all double quotes and trim whitespace
-    normalized = column_id.replace('"', '').strip()
+    if '"' not in column_id and column_id.isupper() and not column_id[0].isspace() and not column_id[-1].isspace():
+        # Already unquoted, trimmed and upper-case (e.g. mapping keys): nothing to clean up
+        normalized = column_id
+    else:
+        # Remove all double quotes, trim whitespace and upper-case for case-insensitive matching
+        normalized = column_id.translate(_QUOTE_TABLE).strip().upper()
     
-    # Convert to lowercase for case-insensitive matching
-    normalized = normalized.upper() # Changed to lower as per previous discussions for consistency
+    # Up to 3 components (schema.table.column) the identifier is already in its final form
+    if normalized.count('.') < 3:
+        return normalized
     
-    # Split by dots to get components
-    parts = normalized.split('.')
-    
-    # Return the last 3 components at most (schema.table.column) or fewer if not available
-    return '.'.join(parts[-3:]) if len(parts) >= 3 else normalized
+    # Return the last 3 components (schema.table.column)
+    return '.'.join(normalized.split('.')[-3:])
+
+
+@functools.lru_cache(maxsize=16384)
+def _norm_last_component(normalized_column_id):
+    """Last dotted part (the column name) of an already-normalized identifier."""
+    return normalized_column_id.rsplit('.', 1)[-1]
+
 
+def pbi_dax_reference(match):
+    """'Table'[Column] DAX reference for a match dict, or None if it has no table or column."""
+    dax_reference = match.get("dax_reference")
+    if dax_reference is None:
+        table, column = match.get("table"), match.get("column")
+        if table and column:
+            dax_reference = f"'{table}'[{column}]"
+    return dax_reference
+
+
+def index_column_mappings(mappings_dict):
+    """
+    Precomputes normalized lookups for mappings_dict["db_to_powerbi"] and stores them on the dict:
+      "_norm_entries": [(db_col, normalized_db_col), ...] in mapping-file order
+      "_norm_index":   {normalized_db_col: [position in _norm_entries, ...]}
+      "_last_index":   {last dotted part of normalized_db_col: [position in _norm_entries, ...]}
+      "_match_rows":   [[((table, column), match row template), ...] per position in _norm_entries]
+    """
+    norm_entries = []
+    norm_index = {}
+    last_index = {}
+    match_rows = []
+    for position, (db_col, pbi_column_infos) in enumerate(mappings_dict.get("db_to_powerbi", {}).items()):
+        norm_db_col = normalize_column_identifier(db_col)
+        norm_entries.append((db_col, norm_db_col))
+        # Match dicts only differ in matched_input between lookups, so build everything else once here
+        match_rows.append([
+            ((pbi_info.get("table"), pbi_info.get("column")), {
+                "db_column": db_col,
+                "matched_input": None, # Filled in per lookup
+                "powerbi_column": pbi_info.get("powerbi_column"),
+                "table": pbi_info.get("table"),
+                "column": pbi_info.get("column"),
+                "dax_reference": pbi_dax_reference(pbi_info)
+            })
+            for pbi_info in pbi_column_infos
+        ])
+        if norm_db_col:
+            norm_index.setdefault(norm_db_col, []).append(position)
+            last_index.setdefault(_norm_last_component(norm_db_col), []).append(position)
+    mappings_dict["_norm_entries"] = norm_entries
+    mappings_dict["_norm_index"] = norm_index
+    mappings_dict["_last_index"] = last_index
+    mappings_dict["_match_rows"] = match_rows
+    return mappings_dict
 
 
 def load_column_mappings(file_path=MAPPING_FILE_PATH):
+    """
+    Loads and indexes the mapping file once per process and file version; the result is shared
+    by all sessions and must be treated as read-only. Editing the file (new mtime) forces a reload.
+    """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)  # Load the entire JSON object
+        file_mtime = os.path.getmtime(file_path)
+    except OSError:
+        file_mtime = None # Missing/unreadable file; the loader reports the error
+    return _load_column_mappings_cached(file_path, file_mtime)
+
+
+@st.cache_resource(show_spinner=False)
+def _load_column_mappings_cached(file_path, file_mtime):
+    try:
+        with open(file_path, 'rb') as f:
+            # Load the entire JSON object (orjson.JSONDecodeError subclasses json.JSONDecodeError)
+            data = orjson.loads(f.read()) if orjson is not None else json.loads(f.read().decode('utf-8'))
             # Extract the actual mappings dictionary which is nested under the "mappings" key
             mappings_dict = data.get("mappings")
             if mappings_dict and isinstance(mappings_dict, dict):
-                # Successfully extracted the nested "mappings" object
-                return mappings_dict
+                # Successfully extracted the nested "mappings" object.
+                # Tag it with a version so cached lookups are invalidated when the file changes.
+                mappings_dict["_version"] = f"{file_path}:{file_mtime}"
+                return index_column_mappings(mappings_dict)
             else:
                 # "mappings" key is missing or not a dictionary
                 print(f"ERROR: 'mappings' key not found or is not a dictionary in {file_path}. File content might be malformed.")
@@ -55,76 +139,70 @@ def find_matching_powerbi_columns(db_column_from_sql, mappings_dict):
         "matched_input": "DB_COLUMN_FROM_SQL_LINEAGE",
         "powerbi_column": "PBI_TABLE.PBI_COLUMN_NAME", # Full PBI identifier
         "table": "PBI_TABLE_NAME",
-        "column": "PBI_COLUMN_NAME"
+        "column": "PBI_COLUMN_NAME",
+        "dax_reference": "'PBI_TABLE_NAME'[PBI_COLUMN_NAME]" # None if table or column is missing
     }
+    Results are cached across reruns for mappings loaded via load_column_mappings.
     """
-    if not db_column_from_sql or not mappings_dict or "db_to_powerbi" not in mappings_dict:
+    if not db_column_from_sql:
         return []
-        
+    if not mappings_dict or "db_to_powerbi" not in mappings_dict:
+        return []
+
+    mappings_version = mappings_dict.get("_version")
+    if mappings_version is None:
+        # Mappings not produced by load_column_mappings; nothing stable to key a cache on
+        return _match_powerbi_columns(db_column_from_sql, mappings_dict)
+    return _cached_match_powerbi_columns(db_column_from_sql, mappings_version, mappings_dict)
+
+
+@st.cache_data(show_spinner=False, max_entries=1024)
+def _cached_match_powerbi_columns(db_column_from_sql, mappings_version, _mappings_dict):
+    # _mappings_dict is excluded from hashing by Streamlit; mappings_version identifies it.
+    return _match_powerbi_columns(db_column_from_sql, _mappings_dict)
+
+
+def _match_powerbi_columns(db_column_from_sql, mappings_dict):
     norm_sql_col = normalize_column_identifier(db_column_from_sql)
     
     if not norm_sql_col:
         return []
 
-    found_matches = []
-    
-    # Iterate through each database column entry in the mapping file
-    for db_col_from_mapping, pbi_column_infos_list in mappings_dict["db_to_powerbi"].items():
-        norm_mapping_col = normalize_column_identifier(db_col_from_mapping)
+    sql_last_part = _norm_last_component(norm_sql_col)
+
+    if "_match_rows" not in mappings_dict:
+        index_column_mappings(mappings_dict)
+    match_rows = mappings_dict["_match_rows"]
+    norm_entries = mappings_dict["_norm_entries"]
+
+    # Primary match based on normalized identifiers: a single dict probe
+    matched_positions = set(mappings_dict["_norm_index"].get(norm_sql_col, ()))
 
-        if not norm_mapping_col: 
+    # Fallback Strategy (for mapping keys that did not match exactly)
+    # Only keys whose column name (last part) is the same are candidates, and those are bucketed at load time
+    sql_col_len = len(norm_sql_col)
+    for position in mappings_dict["_last_index"].get(sql_last_part, ()):
+        if position in matched_positions:
             continue
-        
-        # Primary match based on normalized identifiers
-        if norm_sql_col == norm_mapping_col:
-            for pbi_single_mapping_info in pbi_column_infos_list:
-                found_matches.append({
-                    "db_column": db_col_from_mapping,       
-                    "matched_input": db_column_from_sql,    
-                    "powerbi_column": pbi_single_mapping_info.get("powerbi_column"),
-                    "table": pbi_single_mapping_info.get("table"),
-                    "column": pbi_single_mapping_info.get("column")
-                })
-            # If a direct normalized match is found for the mapping key,
-            # we've processed all its PBI targets for the current SQL input.
-            # Continue to the next mapping key.
-            continue 
-
-        # Fallback Strategy (if primary normalized match failed for this mapping key)
-        # Check if the column name part (last part) matches and one is a suffix of the other
-        sql_parts = norm_sql_col.split('.')
-        map_parts = norm_mapping_col.split('.')
-        if sql_parts[-1] == map_parts[-1]: # Column names (last part) are the same
-            # And one normalized string is a suffix of the other
-            if norm_sql_col.endswith(norm_mapping_col) or norm_mapping_col.endswith(norm_sql_col):
-                # Check if this specific mapping entry's PBI targets were already added from a previous, more direct match
-                # This is to avoid adding the same PBI target multiple times if different normalization paths lead to it.
-                # A more robust deduplication can be done at the end.
-                for pbi_single_mapping_info in pbi_column_infos_list:
-                    # Simplified: add and deduplicate later if necessary, or ensure this logic is tight.
-                    # For now, let's assume this fallback is less common or distinct enough.
-                    found_matches.append({
-                        "db_column": db_col_from_mapping,
-                        "matched_input": db_column_from_sql,
-                        "powerbi_column": pbi_single_mapping_info.get("powerbi_column"),
-                        "table": pbi_single_mapping_info.get("table"),
-                        "column": pbi_single_mapping_info.get("column")
-                    })
-
-    # Deduplicate found_matches to ensure each unique PBI target for the input SQL column is listed once.
-    if found_matches:
-        unique_matches_tuples = set()
-        unique_found_matches = []
-        for match_dict in found_matches:
-            # Define uniqueness by the input SQL column and the target PBI table.column
-            identifying_tuple = (
-                match_dict.get("matched_input"), # The original SQL column string we are trying to map
-                match_dict.get("table"),         # Target PBI table
-                match_dict.get("column")         # Target PBI column
-            )
-            if identifying_tuple not in unique_matches_tuples:
-                unique_matches_tuples.add(identifying_tuple)
-                unique_found_matches.append(match_dict)
-        return unique_found_matches
-            
-    return []
+        norm_mapping_col = norm_entries[position][1]
+        # One normalized string must be a suffix of the other; only the longer one can end with the shorter.
+        # Equal lengths would mean equal strings, which the exact lookup above already matched.
+        mapping_col_len = len(norm_mapping_col)
+        if sql_col_len > mapping_col_len:
+            if norm_sql_col.endswith(norm_mapping_col):
+                matched_positions.add(position)
+        elif mapping_col_len > sql_col_len:
+            if norm_mapping_col.endswith(norm_sql_col):
+                matched_positions.add(position)
+
+    # Emit matches in mapping-file order so the first match stays the default choice downstream.
+    # Each unique PBI target (table, column) for the input SQL column is listed once.
+    found_matches = []
+    seen_pbi_targets = set()
+    for position in sorted(matched_positions):
+        for pbi_target, match_row in match_rows[position]:
+            if pbi_target in seen_pbi_targets:
+                continue
+            seen_pbi_targets.add(pbi_target)
+            found_matches.append(dict(match_row, matched_input=db_column_from_sql))
+    return found_matches
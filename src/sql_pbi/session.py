@@ -9,6 +9,8 @@ def initialize_session_state():
         st.session_state['sql_query'] = ""
     if 'lineage_data' not in st.session_state:
         st.session_state['lineage_data'] = None
+    if 'lineage_df' not in st.session_state:
+        st.session_state['lineage_df'] = None
     if 'all_types' not in st.session_state:
         st.session_state['all_types'] = []
     if 'dax_expressions' not in st.session_state:
@@ -17,6 +19,12 @@ def initialize_session_state():
         st.session_state['column_mappings'] = load_column_mappings()
     if 'mapping_results' not in st.session_state:
         st.session_state['mapping_results'] = None
+    if 'mapping_results_version' not in st.session_state:
+        st.session_state['mapping_results_version'] = 0
+    if 'base_col_pbi_matches' not in st.session_state:
+        st.session_state['base_col_pbi_matches'] = {}
+    if 'mapping_stats' not in st.session_state:
+        st.session_state['mapping_stats'] = None
     if 'base_col_ambiguity_choices' not in st.session_state:
         st.session_state['base_col_ambiguity_choices'] = {}
     if 'visual_selected_values' not in st.session_state: